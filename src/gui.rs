@@ -25,10 +25,17 @@ use serialport;
 struct BrainModel {
     version: Option<String>,
     n_channels: usize,
+    window_size: Option<usize>,
+    // ln(window_size)；log(mean(z²)) = log(sum(z²)) - log_T_offset
+    #[serde(rename = "log_T_offset")]
+    log_t_offset: Option<f64>,
     csp_filters: Option<Vec<Vec<f64>>>,
     lda_coef: Option<Vec<Vec<f64>>>,
     lda_intercept: Option<Vec<f64>>,
     classes: Vec<String>,
+    // 新版训练脚本把数值参数 (float32，含 lda_intercept_sum_power) 放在同目录的 .npz 中，
+    // JSON 仅含元数据；上面的权重字段只出现在 1.0 版 JSON 中
+    npz_path: Option<String>,
 }
 
 #[derive(Debug, Clone)]
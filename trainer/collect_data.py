@@ -1,5 +1,6 @@
 import time
 import os
+import numpy as np
 import pandas as pd
 from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds
 
@@ -17,14 +18,35 @@ def record_session(label, duration=10):
         board.start_stream()
         
         print(f"🔴 开始录制 [{label}] ... 保持 {duration} 秒")
-        time.sleep(duration)
-        
-        # 获取数据并停止
-        data = board.get_board_data()
+
+        # 边录边取：定时清空 BrainFlow 环形缓冲区，写入预分配的数组，避免长时间录制溢出
+        n_rows = BoardShim.get_num_rows(board_id)
+        sfreq = BoardShim.get_sampling_rate(board_id)
+        buf = np.empty((n_rows, int(sfreq * duration * 1.5)), dtype=np.float64)
+        cursor = 0
+
+        start = time.monotonic()
+        while True:
+            finished = time.monotonic() - start >= duration
+            new = board.get_board_data()
+            n = new.shape[1]
+            if cursor + n > buf.shape[1]:
+                # 预分配不够时翻倍扩容 (正常采样率下不会触发)
+                grown = np.empty((n_rows, max(buf.shape[1] * 2, cursor + n)), dtype=np.float64)
+                grown[:, :cursor] = buf[:, :cursor]
+                buf = grown
+            buf[:, cursor:cursor + n] = new
+            cursor += n
+            if finished:
+                break
+            time.sleep(0.25)
+
+        # 停止
+        data = buf[:, :cursor]
         board.stop_stream()
         board.release_session()
         
-        # 2. 保存为 CSV (格式必须与 Rust 保持一致)
+        # 2. 保存为 Parquet (列名与 Rust 的 CSV 保持一致，训练脚本两种格式都读)
         # Rust 格式: Timestamp, Ch0...Ch15
         # BrainFlow 原始数据里: 
         # Row 0 = Package Num (我们不需要)
@@ -37,7 +59,8 @@ def record_session(label, duration=10):
         
         # 拼接数据: [Timestamp, EEG_1 ... EEG_16]
         # 注意：我们需要转置(Transpose)成 (n_samples, n_features)
-        df_data = pd.DataFrame(data[eeg_channels].T) 
+        # EEG 列直接存 float32，训练端读取时无需再转换
+        df_data = pd.DataFrame(data[eeg_channels].T.astype(np.float32))
         timestamps = data[timestamp_channel].T
         
         # 插入时间戳到第一列
@@ -49,8 +72,8 @@ def record_session(label, duration=10):
         
         # 保存文件
         timestamp_str = int(time.time())
-        filename = f"../training_data_{label}_{timestamp_str}.csv"
-        df_data.to_csv(filename, index=False)
+        filename = f"../training_data_{label}_{timestamp_str}.parquet"
+        df_data.to_parquet(filename, engine="pyarrow", compression="zstd", index=False)
         
         print(f"✅ 数据已保存: {filename}")
         print(f"📊 样本数: {df_data.shape[0]}")
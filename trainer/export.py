@@ -1,15 +1,19 @@
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import glob
 import os
 
 def visualize_latest_data():
     data_dir = "../"
-    # 找到最新的 CSV 文件
+    # 找到最新的录制文件 (Rust 端写 CSV，Python 端写 Parquet)
     csv_files = glob.glob(os.path.join(data_dir, "training_data_*.csv"))
+    csv_files += glob.glob(os.path.join(data_dir, "training_data_*.parquet"))
     
     if not csv_files:
-        print("❌ 没有找到 CSV 数据文件！请先录制。")
+        print("❌ 没有找到 CSV / Parquet 数据文件！请先录制。")
         return
 
     # 按时间排序，取最后一个
@@ -17,29 +21,44 @@ def visualize_latest_data():
     print(f"📈 正在可视化文件: {latest_file}")
 
     try:
-        # 读取数据
-        df = pd.read_csv(latest_file)
+        # 我们只画前 8 个通道 (Ch0 - Ch7)，画太多看不清
+        channels_to_plot = 8
+        wanted = [f"Ch{i}" for i in range(channels_to_plot)]
+
+        # 读取数据 (只读要画的通道)
+        if latest_file.endswith(".parquet"):
+            names = pq.read_schema(latest_file).names
+            df = pd.read_parquet(latest_file, columns=[c for c in wanted if c in names])
+        else:
+            df = pd.read_csv(latest_file, usecols=lambda c: c in wanted)
+        cols = [c for c in wanted if c in df.columns]
         
         # 检查数据量
-        if df.empty:
+        if df.empty or not cols:
             print("⚠️ 文件是空的！")
             return
 
-        # 设置绘图
-        plt.figure(figsize=(15, 10))
-        plt.suptitle(f"Data Inspection: {os.path.basename(latest_file)}", fontsize=16)
+        # 所有通道叠放在同一坐标轴，用一个 LineCollection 一次绘制
+        # 各通道去掉直流偏置后按最大幅度等间距排开
+        # to_numpy 可能返回只读视图 (如 Parquet 的 float32 列)，这里显式拷贝
+        data = np.array(df[cols], dtype=np.float64)
+        data -= data.mean(axis=0)
+        offset = np.ptp(data, axis=0).max() or 1.0
+        n = data.shape[0]
+        x = np.arange(n)
+        segs = [np.column_stack([x, data[:, i] - i * offset]) for i in range(len(cols))]
 
-        # 我们只画前 8 个通道 (Ch0 - Ch7)，画太多看不清
-        channels_to_plot = 8
-        for i in range(channels_to_plot):
-            col_name = f"Ch{i}"
-            if col_name in df.columns:
-                plt.subplot(channels_to_plot, 1, i+1)
-                plt.plot(df[col_name], label=col_name, color='C'+str(i), linewidth=0.8)
-                plt.legend(loc="upper right")
-                plt.ylabel("uV")
-                if i == 0:
-                    plt.title("Raw EEG Waveforms (First 8 Channels)")
+        fig, ax = plt.subplots(figsize=(15, 10))
+        fig.suptitle(f"Data Inspection: {os.path.basename(latest_file)}", fontsize=16)
+        ax.add_collection(
+            LineCollection(segs, linewidths=0.8, colors=[f"C{i}" for i in range(len(cols))])
+        )
+        ax.set_xlim(0, max(n - 1, 1))
+        ax.set_ylim(-(len(cols) - 0.5) * offset, 0.5 * offset)
+        ax.set_yticks([-i * offset for i in range(len(cols))])
+        ax.set_yticklabels(cols)
+        ax.set_ylabel(f"uV (spacing {offset:.0f} uV)")
+        ax.set_title(f"Raw EEG Waveforms (First {channels_to_plot} Channels)")
         
         plt.xlabel("Sample Point")
         plt.tight_layout()
@@ -1,17 +1,23 @@
+import csv
 import glob
 import json
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 
-import mne
 import numpy as np
-import pandas as pd
-from mne.decoding import CSP
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import scipy.linalg
+from joblib import parallel_backend
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.model_selection import StratifiedKFold, cross_val_score
 from sklearn.pipeline import Pipeline
 
 # ================= 配置区 =================
-# CSV 文件所在的路径 (相对于当前脚本)
+# 录制文件 (CSV / Parquet) 所在的路径 (相对于当前脚本)
 DATA_DIR = "../"
 # 采样率 (转换脚本会重采样到 125 Hz)
 SFREQ = 125
@@ -22,84 +28,436 @@ LABELS_MAP = {
     "fists": 2,  # 双手想象
     "feet": 3,   # 双脚想象
 }
+# 所有 key 编译成一个忽略大小写的正则，一次扫描完成匹配 (文件名中最靠前的 key 生效)
+LABEL_RE = re.compile("|".join(re.escape(k) for k in LABELS_MAP), re.IGNORECASE)
+LABEL_LOOKUP = {k.lower(): v for k, v in LABELS_MAP.items()}
+# 切片参数 (1s 窗口，0.5s 步长)
+WINDOW_SIZE = int(SFREQ * 1.0)
+STRIDE = int(SFREQ * 0.5)
+# CSP 增量累加量：只为新增录制计算协方差 (所有录制仍会被加载，用于拟合 LDA)
+CORESET_FILE = os.path.join(DATA_DIR, "csp_coreset.npz")
 # ========================================
 
 
+def epoch_windows(data, window_size, stride):
+    """
+    按滑动窗口切片 (n_channels, n_samples) -> (n_epochs, n_channels, window_size)
+    返回零拷贝视图，由调用方一次性拷入目标数组
+    """
+    sw = np.lib.stride_tricks.sliding_window_view(data, window_shape=window_size, axis=1)
+    # sw: (n_channels, n_windows, window_size)
+    return np.transpose(sw[:, ::stride, :], (1, 0, 2))
+
+
+def count_epochs(n_samples, window_size=WINDOW_SIZE, stride=STRIDE):
+    return max(0, (n_samples - window_size) // stride + 1)
+
+
+def infer_label(filename):
+    """文件名包含 LABELS_MAP 的 key 即视为该类，未知返回 None"""
+    m = LABEL_RE.search(filename)
+    return LABEL_LOOKUP[m.group(0).lower()] if m else None
+
+
+def recording_signature(path):
+    """(字节数, 修改时间 ns)：被同名、旧时间戳的文件替换时也能发现"""
+    st = os.stat(path)
+    return int(st.st_size), int(st.st_mtime_ns)
+
+
+def read_recording(path):
+    """
+    读取一份录制的 EEG 通道 (不含 Timestamp 列)
+    Parquet 按列只读通道；CSV 格式：Timestamp, Ch0, Ch1...
+    """
+    if path.endswith(".parquet"):
+        names = [n for n in pq.read_schema(path).names if n != "Timestamp"]
+        return pq.read_table(path, columns=names, use_threads=True)
+    # 只转换通道列且直接解析为 float32，Timestamp 列不做数值转换
+    # 表头用 csv 模块解析 (处理引号)，utf-8-sig 去掉 BOM，列名与 pyarrow 看到的一致
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        header = next(csv.reader(f), [])
+    names = [n for n in header if n.strip() != "Timestamp"]
+    return pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=names,
+            column_types={n: pa.float32() for n in names},
+        ),
+    )
+
+
+def bin_paths(path):
+    """training_data_x.csv / .parquet -> (training_data_x.f32.bin, training_data_x.f32.json)"""
+    stem = os.path.splitext(path)[0]
+    return stem + ".f32.bin", stem + ".f32.json"
+
+
+def read_bin_shape(path):
+    """
+    二进制副本完整且与源文件签名一致时返回其 (n_channels, n_samples)，否则返回 None
+    """
+    bin_path, meta_path = bin_paths(path)
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if tuple(meta["source"]) != recording_signature(path):
+            return None
+        n_channels, n_samples = (int(v) for v in meta["shape"])
+        # 副本被删除或截断时重新转换
+        if os.path.getsize(bin_path) != 4 * n_channels * n_samples:
+            return None
+        return n_channels, n_samples
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _ensure_bin(path):
+    """
+    把 CSV / Parquet 录制转成 float32 原始二进制 (单位 V，按通道行优先)，已是最新则跳过
+    返回: (n_channels, n_samples)，失败返回 None
+    """
+    shape = read_bin_shape(path)
+    if shape is not None:
+        return shape
+
+    filename = os.path.basename(path)
+    print(f"   -> Converting: {filename}")
+    try:
+        source = recording_signature(path)
+        table = read_recording(path)
+        # 按通道行优先存放 (n_channels, n_samples)：每个窗口在每个通道上都是连续内存
+        data = np.empty((table.num_columns, table.num_rows), dtype=np.float32)
+        for i, col in enumerate(table.columns):
+            data[i] = col.to_numpy(zero_copy_only=False)
+
+        # 单位从 µV 转 V (原地)
+        data *= np.float32(1e-6)
+
+        bin_path, meta_path = bin_paths(path)
+        data.tofile(bin_path)
+        # 元数据最后写入，中途失败的副本不会被当成有效缓存
+        with open(meta_path, "w") as f:
+            json.dump({"shape": list(data.shape), "source": list(source)}, f)
+        return data.shape
+
+    except Exception as e:
+        print(f"Error reading {filename}: {e}")
+        return None
+
+
+def _load_one(path):
+    """
+    以内存映射读取单个文件并切片，不经过 CSV 解析
+    返回: (X_i (n_epochs, n_channels, n_times) float32 视图, 标签)，失败返回 None
+    """
+    filename = os.path.basename(path)
+    label = infer_label(filename)
+    if label is None:
+        return None
+
+    shape = _ensure_bin(path)
+    if shape is None or shape[1] < WINDOW_SIZE:
+        return None
+
+    try:
+        data = np.memmap(bin_paths(path)[0], dtype=np.float32, mode="r", shape=shape)
+    except (OSError, ValueError) as e:
+        print(f"Error reading {filename}: {e}")
+        return None
+    return epoch_windows(data, WINDOW_SIZE, STRIDE), label
+
+
+def find_recordings():
+    """
+    扫描 ../training_data_*.csv 与 *.parquet，同名时优先 Parquet
+    (Rust 录制端写 CSV，Python 备用录制端写 Parquet)
+    """
+    recordings = {}
+    for ext in ("csv", "parquet"):
+        for path in glob.glob(os.path.join(DATA_DIR, f"training_data_*.{ext}")):
+            recordings[os.path.splitext(path)[0]] = path
+    return sorted(recordings.values())
+
+
+def gen_blocks(jobs):
+    """
+    逐文件产出 (文件路径, 预计 epoch 数, epoch 视图, 标签)，读取失败的文件跳过
+    jobs: [(文件路径, 标签, 预计 epoch 数)]，标签沿用扫描阶段的结果
+    视图直接映射在二进制副本上，调用方拷入目标数组后即可释放，不在列表中累积
+    """
+    for file, label, expected in jobs:
+        print(f"   -> Loading: {os.path.basename(file)} [Label: {label}]")
+        result = _load_one(file)
+        if result is None:
+            continue
+        yield file, expected, result[0], label
+
+
 def load_csv_data():
     """
-    自动扫描并加载 ../training_data_*.csv
-    返回: X (n_epochs, n_channels, n_times), y (labels)
+    自动扫描并加载 ../training_data_*.csv / *.parquet
+    返回: X (n_epochs, n_channels, n_times), y (labels),
+          spans [(文件路径, 起始下标, 结束下标)]：每个文件在 X 中占的区间
     """
     print(f"Scanning for data in {os.path.abspath(DATA_DIR)} ...")
 
-    csv_files = glob.glob(os.path.join(DATA_DIR, "training_data_*.csv"))
+    csv_files = find_recordings()
     if not csv_files:
-        print("❌ Error: No CSV files found!")
+        print("❌ Error: No CSV / Parquet files found!")
         print("   -> 请先运行数据转换/录制生成 training_data_*.csv")
-        return None, None
-
-    all_epochs = []
-    all_labels = []
-    inferred_channels = None
+        return None, None, None
 
+    # 1. 自动识别标签
+    labeled = {}
     for file in csv_files:
         filename = os.path.basename(file)
-
-        # 1. 自动识别标签
-        label = None
-        for name, val in LABELS_MAP.items():
-            if name.lower() in filename.lower():
-                label = val
-                break
-
+        label = infer_label(filename)
         if label is None:
             print(f"Warning: Skipping unknown file: {filename} (Label not in LABELS_MAP)")
             continue
+        labeled[file] = label
 
-        print(f"   -> Loading: {filename} [Label: {label}]")
+    # 2. 新录制 / 被修改的文件在进程池中并行转换为二进制，其余直接读元数据
+    shapes = {file: read_bin_shape(file) for file in labeled}
+    stale = [file for file, shape in shapes.items() if shape is None]
+    if stale:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+            shapes.update(zip(stale, ex.map(_ensure_bin, stale)))
 
-        # 2. 读取 CSV
-        try:
-            df = pd.read_csv(file)
-            # 格式：Timestamp, Ch0, Ch1...
-            data = df.iloc[:, 1:].values.T  # (n_channels, n_samples)
-            if inferred_channels is None:
-                inferred_channels = data.shape[0]
+    jobs = []
+    inferred_channels = None
+    for file, label in labeled.items():
+        if shapes[file] is None:
+            continue
+        n_channels, n_samples = shapes[file]
 
-            # 单位从 µV 转 V
-            data = data * 1e-6
+        if inferred_channels is None:
+            inferred_channels = n_channels
+        elif n_channels != inferred_channels:
+            print(f"Warning: Skipping {os.path.basename(file)}: {n_channels} channels, expected {inferred_channels}")
+            continue
 
-            # 3. 切片 (1s 窗口，0.5s 步长)
-            n_channels, n_samples = data.shape
-            window_size = int(SFREQ * 1.0)
-            stride = int(SFREQ * 0.5)
+        expected = count_epochs(n_samples)
+        if expected > 0:
+            jobs.append((file, label, expected))
 
-            if n_samples < window_size:
-                continue
+    total = sum(k for _, _, k in jobs)
+    if total == 0:
+        print("Loaded files but found no valid epochs.")
+        return None, None, None
 
-            for start in range(0, n_samples - window_size + 1, stride):
-                end = start + window_size
-                segment = data[:, start:end]
-                all_epochs.append(segment)
-                all_labels.append(label)
+    # 3. 一次性分配，逐文件从内存映射原地填充
+    X = np.empty((total, inferred_channels, WINDOW_SIZE), dtype=np.float32)
+    y = np.empty(total, dtype=np.int8)
+    idx = 0
+    spans = []
 
-        except Exception as e:
-            print(f"Error reading {filename}: {e}")
+    for file, expected, block, label in gen_blocks(jobs):
+        k = min(block.shape[0], expected)
+        X[idx:idx + k] = block[:k]
+        y[idx:idx + k] = label
+        spans.append((file, idx, idx + k))
+        idx += k
 
-    if not all_epochs:
+    if idx == 0:
         print("Loaded files but found no valid epochs.")
-        return None, None
+        return None, None, None
 
-    X = np.array(all_epochs)
-    y = np.array(all_labels)
+    # 读取失败的文件会留下空位，截掉即可 (切片不拷贝)
+    X = X[:idx]
+    y = y[:idx]
 
     print(f"   Inferred channels: {inferred_channels}")
-    return X, y
+    return X, y, spans
+
+
+def centred_scatter(X, idx, chunk=256):
+    """
+    单类去均值后的散布量 Σ (x-μ)(x-μ)ᵀ、均值 μ 与样本数，全程 float64
+    先减均值再相乘：原始录制带很大的直流偏置，E[xxᵀ] - μμᵀ 会严重抵消
+    X: (n_epochs, n_channels, n_times)，idx: 该类 epoch 的下标
+    """
+    n_channels = X.shape[1]
+    mean = np.zeros(n_channels)
+    for i in range(0, len(idx), chunk):
+        mean += X[idx[i:i + chunk]].sum(axis=(0, 2), dtype=np.float64)
+    n = len(idx) * X.shape[2]
+    mean /= n
+
+    M2 = np.zeros((n_channels, n_channels))
+    for i in range(0, len(idx), chunk):
+        block = X[idx[i:i + chunk]].astype(np.float64)
+        block -= mean[:, None]
+        M2 += np.einsum("ect,edt->cd", block, block, optimize=True)
+    return M2, mean, n
+
+
+def merge_scatter(a, b):
+    """
+    合并两份去均值散布量 (M2, μ, n)，并行方差 (Chan) 更新，float64
+    """
+    M2_a, mean_a, n_a = a
+    M2_b, mean_b, n_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    M2 = M2_a + M2_b + np.outer(delta, delta) * (n_a * n_b / n)
+    return M2, mean, n
+
+
+def scatter_to_covariance(M2, mean, n):
+    """由去均值散布量得到按迹归一化的二阶矩 M2/n + μμᵀ"""
+    cov = M2 / n + np.outer(mean, mean)
+    return cov / np.trace(cov)
+
+
+def class_covariance(X, idx):
+    """
+    单类的通道协方差 (按迹归一化) -> (n_channels, n_channels)
+    与 mne.decoding.CSP 一致取未去均值的二阶矩 E[xxᵀ] (assume_centered)，
+    与 log 平均功率特征同口径；由去均值散布量合成 M2/n + μμᵀ，两项均半正定，不会抵消
+    """
+    return scatter_to_covariance(*centred_scatter(X, idx))
+
+
+def csp_filters(covs):
+    """
+    由各类协方差解广义特征值问题求 CSP 空间滤波器
+    返回: filters (n_channels, n_channels)，行按判别力从高到低排列
+    """
+    if len(covs) < 2:
+        raise ValueError("CSP needs at least two classes")
+
+    composite = np.sum(covs, axis=0)
+    n_channels = composite.shape[0]
+
+    if len(covs) == 2:
+        eigvals, eigvecs = scipy.linalg.eigh(covs[0], composite)
+        # 特征值升序：两端分别对应两类方差最大，交替取两端
+        order = np.empty(len(eigvals), dtype=int)
+        order[0::2] = np.arange(len(eigvals))[::-1][: (len(eigvals) + 1) // 2]
+        order[1::2] = np.arange(len(eigvals))[: len(eigvals) // 2]
+        return eigvecs[:, order].T
+
+    # 多类：每类对其余类做一对多，轮流取各类最强的滤波器
+    per_class = []
+    for cov in covs:
+        _, eigvecs = scipy.linalg.eigh(cov, composite)
+        per_class.append(eigvecs[:, ::-1].T)
+    return np.stack(per_class, axis=1).reshape(-1, n_channels)[:n_channels]
+
+
+def fit_csp(X, y):
+    """直接在 epoch 数组上拟合 CSP 滤波器"""
+    return csp_filters([class_covariance(X, np.flatnonzero(y == c)) for c in np.unique(y)])
+
+
+class CSP(BaseEstimator, TransformerMixin):
+    """
+    CSP + log 平均功率特征 (替代 mne.decoding.CSP(log=True))
+    """
+
+    def __init__(self, n_components=4):
+        self.n_components = n_components
+
+    def fit(self, X, y):
+        self.filters_ = fit_csp(X, y)
+        return self
+
+    def transform(self, X):
+        W = self.filters_[: self.n_components].astype(X.dtype, copy=False)
+        Z = np.einsum("kc,ect->ekt", W, X, optimize=True)
+        return np.log(np.mean(Z * Z, axis=-1))
+
+
+def load_csp_coreset():
+    """
+    读取 CSP 累加量 (per-class 去均值散布量 M2 / 均值 / 样本数，及已收录文件的签名)
+    切片参数变化时作废，返回 None
+    """
+    try:
+        with np.load(CORESET_FILE) as npz:
+            if int(npz["window_size"]) != WINDOW_SIZE or int(npz["stride"]) != STRIDE:
+                return None
+            return {
+                "files": {
+                    name: tuple(int(v) for v in sig)
+                    for name, sig in zip(npz["files"].tolist(), npz["signatures"])
+                },
+                "classes": {
+                    int(c): (M2, mean, int(n))
+                    for c, M2, mean, n in zip(npz["classes"], npz["M2"], npz["mean"], npz["n"])
+                },
+            }
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_csp_coreset(core):
+    classes = sorted(core["classes"])
+    names = sorted(core["files"])
+    try:
+        np.savez(
+            CORESET_FILE,
+            files=np.array(names, dtype=str),
+            signatures=np.array([core["files"][n] for n in names], dtype=np.int64).reshape(-1, 2),
+            classes=np.array(classes, dtype=np.int32),
+            M2=np.stack([core["classes"][c][0] for c in classes]),
+            mean=np.stack([core["classes"][c][1] for c in classes]),
+            n=np.array([core["classes"][c][2] for c in classes], dtype=np.int64),
+            window_size=WINDOW_SIZE,
+            stride=STRIDE,
+        )
+    except OSError as e:
+        print(f"Warning: Failed to write CSP coreset: {e}")
+
+
+def update_csp_coreset(X, y, spans):
+    """
+    把新增录制在 X 中的区间累加进 CSP 累加量，不重复读取任何文件
+    节省的只是已收录文件的协方差计算 (O(N·C²))；所有录制仍由 load_csv_data 完整加载
+    已收录的文件被修改、替换或未能加载时从头重建
+    返回: 各类协方差 (按类别升序)，不可用时返回 None
+    """
+    signatures = {os.path.basename(f): recording_signature(f) for f, _, _ in spans}
+    n_channels = X.shape[1]
+
+    core = load_csp_coreset()
+    if core is not None:
+        stale = any(signatures.get(name) != sig for name, sig in core["files"].items()) or any(
+            M2.shape != (n_channels, n_channels) for M2, _, _ in core["classes"].values()
+        )
+        if stale:
+            core = None
+    if core is None:
+        core = {"files": {}, "classes": {}}
+
+    new_spans = [span for span in spans if os.path.basename(span[0]) not in core["files"]]
+    if new_spans:
+        print(f"Updating CSP coreset with {len(new_spans)} new file(s)...")
+    for file, start, stop in new_spans:
+        if stop == start:
+            continue
+        # 每个文件先按自身均值去中心化，再与已有累加量做 Chan 合并
+        delta = centred_scatter(X, np.arange(start, stop))
+        label = int(y[start])
+        acc = core["classes"].get(label)
+        core["classes"][label] = delta if acc is None else merge_scatter(acc, delta)
+        core["files"][os.path.basename(file)] = signatures[os.path.basename(file)]
+
+    if new_spans:
+        save_csp_coreset(core)
+
+    if len(core["classes"]) < 2:
+        return None
+    return [scatter_to_covariance(*core["classes"][c]) for c in sorted(core["classes"])]
 
 
 def train_and_export():
     # 1. 准备数据
-    X, y = load_csv_data()
+    X, y, spans = load_csv_data()
     if X is None:
         return
 
@@ -112,41 +470,83 @@ def train_and_export():
     # 2. 定义模型 (CSP + LDA)
     n_channels = X.shape[1]
     n_components = min(8, max(2, n_channels - 1))
-    csp = CSP(n_components=n_components, reg=None, log=True, norm_trace=False)
+    csp = CSP(n_components=n_components)
     lda = LinearDiscriminantAnalysis()
     pipeline = Pipeline([("CSP", csp), ("LDA", lda)])
 
     # 3. 交叉验证
     cv = StratifiedKFold(n_splits=5, shuffle=True)
     try:
-        scores = cross_val_score(pipeline, X, y, cv=cv, scoring="accuracy")
+        # 各折并行；loky 会把较大的 X 以 memmap 共享给子进程，不逐折 pickle
+        with parallel_backend("loky"):
+            scores = cross_val_score(
+                pipeline, X, y, cv=cv, scoring="accuracy", n_jobs=-1, error_score="raise"
+            )
         print(f"\nModel Accuracy: {np.mean(scores)*100:.2f}% (+/- {np.std(scores)*100:.2f}%)")
+    except np.linalg.LinAlgError as e:
+        # LinAlgError 是 ValueError 的子类，必须先单独捕获
+        print(f"\n❌ CSP solve failed during Cross-Validation: {e}")
+        print("   -> 检查是否有坏通道 (常数/断线) 或重复通道")
+        return
     except ValueError:
         print("\nNot enough data for Cross-Validation. Training directly...")
 
     # 4. 全量训练
     print("Training final model on full dataset...")
-    pipeline.fit(X, y)
+    X = X.astype(np.float32, copy=False)
+    covs = update_csp_coreset(X, y, spans)
+    try:
+        if covs is not None and len(covs) == len(np.unique(y)):
+            # CSP 由累加量求解，省去对已收录文件的协方差计算；LDA 仍在全量特征上拟合
+            csp.filters_ = csp_filters(covs)
+            lda.fit(csp.transform(X), y)
+        else:
+            pipeline.fit(X, y)
+    except np.linalg.LinAlgError as e:
+        print(f"❌ CSP solve failed: {e}")
+        print("   -> 检查是否有坏通道 (常数/断线) 或重复通道")
+        return
 
-    # 5. 导出模型参数 JSON
+    # 5. 导出模型 (JSON 元数据 + NPZ 数值参数)
     filters = pipeline.named_steps["CSP"].filters_
     lda_step = pipeline.named_steps["LDA"]
 
+    # 特征 log(mean(z²)) = log(sum(z²)) - log(T)，-log(T) 对每个窗口是常数：
+    # 预先折进 LDA 偏置，推理端可直接用 log(sum(z²)) 而省去逐通道的减法
+    log_t_offset = float(np.log(WINDOW_SIZE))
+    intercept_sum_power = lda_step.intercept_ - log_t_offset * lda_step.coef_.sum(axis=1)
+
+    # 数值参数存为 float32 原始缓冲区 (.npz 不压缩，小端)，推理端可直接映射读取；
+    # JSON 只保留元数据
+    output_file = "../brain_model.json"
+    npz_file = os.path.splitext(output_file)[0] + ".npz"
+    np.savez(
+        npz_file,
+        csp_filters=np.ascontiguousarray(filters, dtype="<f4"),
+        lda_coef=np.ascontiguousarray(lda_step.coef_, dtype="<f4"),
+        lda_intercept=np.ascontiguousarray(lda_step.intercept_, dtype="<f4"),
+        lda_intercept_sum_power=np.ascontiguousarray(intercept_sum_power, dtype="<f4"),
+        classes=np.ascontiguousarray(lda_step.classes_, dtype="<i4"),
+    )
+
+    label_names = {v: k for k, v in LABELS_MAP.items()}
     model_data = {
-        "version": "1.0",
+        "version": "2.0",
         "n_channels": int(n_channels),
-        "csp_filters": filters.tolist(),
-        "lda_coef": lda_step.coef_.tolist(),
-        "lda_intercept": lda_step.intercept_.tolist(),
-        "classes": lda_step.classes_.tolist(),
+        "window_size": WINDOW_SIZE,
+        "log_T_offset": log_t_offset,
+        # LDA 输出顺序对应的标签名
+        "classes": [label_names.get(int(c), str(c)) for c in lda_step.classes_],
+        "npz_path": os.path.basename(npz_file),
     }
 
-    output_file = "../brain_model.json"
     with open(output_file, "w") as f:
         json.dump(model_data, f, indent=4)
 
     print(f"\nSuccess! Model saved to: {os.path.abspath(output_file)}")
+    print(f"   Parameters: {os.path.abspath(npz_file)}")
     print("Rust 侧按 classes 顺序解释 LDA 输出即可。")
+    print("特征若用 log(sum(z²))，请配合 lda_intercept_sum_power 使用。")
 
 
 if __name__ == "__main__":